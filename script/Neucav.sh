@@ -581,7 +581,7 @@ output_cor="${output_directory}/${T1_basename}_GM_importance.csv"
 
 python3 "$PYTHON_SCRIPT_SUB" --lesions-path $mask_path -o $output_sub
 python3 "$PYTHON_SCRIPT_COR" --lesions-path $mask_path -o $output_cor
-python3 "$PYTHON_SCRIPT_PLOT" -g $output_cor -w $output_sub -o $output_directory
+python3 "$PYTHON_SCRIPT_PLOT" -g $output_cor -w $output_sub -o $output_directory --publication
 
 
 
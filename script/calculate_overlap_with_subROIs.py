@@ -5,58 +5,231 @@ Created on Thu Aug 21 16:37:09 2025
 @author: ludovicocoletta
 """
 import os
-import glob
+import pickle
 import numpy as np
 import nibabel as nib
-import pandas as pd
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from numba import njit, prange
+except ImportError:  # Numba is optional: fall back to plain NumPy
+    njit = None
+    prange = range
 
-def main(lesions_path, output_path):
-    path_to_maps = '/home/alberto/test_subalpamaps/APSS_Atlas/apss_subcortical_maps'
-    maps = sorted(glob.glob(os.path.join(path_to_maps, '*gz')))
+PATH_TO_MAPS = '/home/alberto/test_subalpamaps/APSS_Atlas/apss_subcortical_maps'
+
+def percentile90(values):
+    # Same linear interpolation as np.percentile(values, 90), via introselect
+    pos = 0.9 * (values.size - 1)
+    lo = int(pos)
+    hi = min(lo + 1, values.size - 1)
+    part = np.partition(values, (lo, hi))
+    # Interpolate in float64, as np.percentile did on the original float64 data
+    lo_val = np.float64(part[lo])
+    return lo_val + (np.float64(part[hi]) - lo_val) * (pos - lo)
+
+def pct90_nonzero(vals, out):
+    # 90th percentile of the non-zero values of each row, 0 when there are none
+    for i in prange(vals.shape[0]):
+        inter = vals[i]
+        nz_count = np.count_nonzero(inter)
+        if nz_count == 0:
+            out[i] = 0  # Handle case where no intersection exists
+            continue
+        # Only copy out the non-zero values when there are zeros to drop
+        non_zero_inter = inter if nz_count == inter.size else inter[inter != 0]
+        out[i] = percentile90(non_zero_inter)
+
+if njit is not None:
+    # Fuse filter and selection per map and spread the maps over all cores
+    percentile90 = njit(cache=True)(percentile90)
+    pct90_nonzero = njit(parallel=True, cache=True)(pct90_nonzero)
+
+def sparse_map(nifti_map):
+    # Flat indices (sorted) and values of the non-zero voxels of one map
+    nifti_data = np.asarray(nib.load(nifti_map).dataobj, dtype=np.float32).ravel()
+    nz_idx = np.flatnonzero(nifti_data)
+    return nz_idx, nifti_data[nz_idx]
+
+def load_sparse_maps(maps):
+    # Maps are independent; gzip decoding releases the GIL so threads overlap it
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        map_nz = list(ex.map(sparse_map, maps))
+    return map_nz, nib.load(maps[0]).shape[:3]
+
+def load_maps_cache(maps, maps_cache):
+    # Reuse the sparse atlas file only if it was built from these exact map
+    # files (same paths and mtimes), otherwise rebuild it
+    mtimes = np.array([os.stat(nifti_map).st_mtime_ns for nifti_map in maps], dtype=np.int64)
+    if os.path.exists(maps_cache):
+        with np.load(maps_cache) as cache:
+            if ('maps' in cache and cache['maps'].tolist() == list(maps)
+                    and np.array_equal(cache['mtimes'], mtimes)):
+                offsets = cache['offsets']
+                nz_idx = cache['nz_idx']
+                nz_vals = cache['nz_vals']
+                map_nz = [(nz_idx[start:stop], nz_vals[start:stop])
+                          for start, stop in zip(offsets[:-1], offsets[1:])]
+                return map_nz, tuple(cache['shape'].tolist())
+    # Otherwise decode every map once and store the non-zero voxels of all maps
+    # back to back, with offsets[i]:offsets[i + 1] delimiting map i
+    map_nz, map_shape = load_sparse_maps(maps)
+    offsets = np.cumsum([0] + [len(nz_idx) for nz_idx, _ in map_nz])
+    with open(maps_cache, 'wb') as f:
+        np.savez(f, maps=np.array(maps), mtimes=mtimes, shape=np.array(map_shape),
+                 offsets=offsets,
+                 nz_idx=np.concatenate([nz_idx for nz_idx, _ in map_nz]),
+                 nz_vals=np.concatenate([nz_vals for _, nz_vals in map_nz]))
+    return map_nz, map_shape
+
+def list_maps(path_to_maps):
+    # The listing is cached per atlas directory and reused while the directory
+    # mtime (which changes whenever maps are added, removed or renamed) is the same
+    cache_path = os.path.join(os.path.expanduser('~'), '.cache',
+                              f'apss_maps_{os.path.basename(path_to_maps)}.pkl')
+    mtime = os.stat(path_to_maps).st_mtime_ns
+    try:
+        with open(cache_path, 'rb') as f:
+            cached_path, cached_mtime, maps, map_names = pickle.load(f)
+        if cached_path == path_to_maps and cached_mtime == mtime:
+            return maps, map_names
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+        pass
+    
+    maps = sorted(e.path for e in os.scandir(path_to_maps)
+                  if e.name.endswith('gz') and not e.name.startswith('.'))
     map_names = [ii.split('_union_randomise_1mm.nii.gz')[0].split('/')[-1] for ii in maps]
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, 'wb') as f:
+            pickle.dump((path_to_maps, mtime, maps, map_names), f)
+    except OSError:
+        pass  # Read-only home: just skip caching
+    return maps, map_names
+
+def main(lesions_path, output_path, maps_cache=None, map_nz=None, map_names=None,
+         map_shape=None):
+    # map_nz/map_names/map_shape let a batch driver pass already loaded sparse maps
+    if map_nz is None or map_names is None:
+        maps, map_names = list_maps(PATH_TO_MAPS)
+    if map_nz is None and maps_cache:
+        map_nz, map_shape = load_maps_cache(maps, maps_cache)
     
     # Handle single lesion file
     lesion = lesions_path
-    df_as_array = np.zeros((1, len(maps)))
+    df_as_array = np.zeros((1, len(map_names)))
     
     # Extract patient ID from lesion path
     pat_ids = [os.path.basename(lesion).split('_')[0]]  # More robust patient ID extraction
     
-    # Load patient lesion data
-    pat_data = nib.load(lesion).get_fdata()
-    pat_data[pat_data!=0]=1
-    # Process each map
-    for nifti_index, nifti_map in enumerate(maps):
-        nifti_data = nib.load(nifti_map).get_fdata()
-        inter = nifti_data * pat_data
+    # Load patient lesion data once
+    pat_img = nib.load(lesion)
+    pat_raw = np.asarray(pat_img.dataobj)
+    # Binarize in a single pass into a 1 byte/voxel mask
+    if pat_raw.dtype.kind in 'biu':
+        pat_mask = pat_raw.astype(bool, copy=False)
+    else:
+        pat_mask = pat_raw != 0
+    if map_nz is not None:
+        # Flat voxel indices are only comparable on the same grid
+        if pat_mask.shape != tuple(map_shape):
+            raise ValueError(f"Lesion grid {pat_mask.shape} does not match atlas grid {tuple(map_shape)}")
+        # Sparse maps: intersect the sorted non-zero voxel indices of each map
+        # with the lesion voxel indices; the selected values are all non-zero
+        lesion_flat = np.flatnonzero(pat_mask)
+        for nifti_index, (nz_idx, nz_vals) in enumerate(map_nz):
+            non_zero_inter = nz_vals[np.isin(nz_idx, lesion_flat, assume_unique=True)]
+            if non_zero_inter.size > 0:
+                df_as_array[0, nifti_index] = percentile90(non_zero_inter)
+            else:
+                df_as_array[0, nifti_index] = 0  # Handle case where no intersection exists
+    else:
+        # Slicing the maps by the lesion box would not notice a different grid
+        map_shape = nib.load(maps[0]).shape[:3]
+        if pat_img.shape[:3] != map_shape:
+            raise ValueError(f"Lesion grid {pat_img.shape[:3]} does not match atlas grid {map_shape}")
         
-        # Calculate 90th percentile of non-zero intersection values
-        non_zero_inter = inter[inter != 0]
-        if len(non_zero_inter) > 0:
-            df_as_array[0, nifti_index] = np.percentile(non_zero_inter, 90)
+        # Crop the lesion to its nonzero bounding box
+        nz = np.argwhere(pat_mask)
+        if len(nz) > 0:
+            mn = nz.min(0)
+            mx = nz.max(0) + 1
         else:
-            df_as_array[0, nifti_index] = 0  # Handle case where no intersection exists
+            mn = mx = np.zeros(pat_mask.ndim, dtype=int)  # Empty lesion: empty crop
+        lesion_mask = pat_mask[mn[0]:mx[0], mn[1]:mx[1], mn[2]:mx[2]]
+        n_voxels = np.count_nonzero(lesion_mask)
+        
+        # Gather the lesion voxels of every map into one (n_maps, n_voxels) buffer
+        vals = np.empty((len(maps), n_voxels), dtype=np.float32)
+        
+        def process(nifti_index, nifti_map):
+            # Only read the sub-volume touching the lesion from the array proxy
+            nifti_data = np.asarray(nib.load(nifti_map).dataobj[mn[0]:mx[0], mn[1]:mx[1], mn[2]:mx[2]],
+                                    dtype=np.float32)
+            # Map empty inside the lesion bounding box: nothing to intersect
+            if not nifti_data.any():
+                vals[nifti_index] = 0
+                return
+            # Boolean indexing keeps lesion voxels only, no masked copy of the volume
+            vals[nifti_index] = nifti_data[lesion_mask]
+        
+        # Maps are independent; gzip decoding releases the GIL so threads overlap it
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+            list(ex.map(process, range(len(maps)), maps))
+        
+        # Calculate 90th percentile of non-zero intersection values
+        pct90_nonzero(vals, df_as_array[0])
     
-    # Save results to Excel
-    df = pd.DataFrame(df_as_array, index=pat_ids, columns=map_names)
-    df.to_csv(output_path)
+    # Save results as a one-row CSV (same layout as DataFrame.to_csv)
+    with open(output_path, 'w') as f:
+        f.write(',' + ','.join(map_names) + '\n')
+        f.write(pat_ids[0] + ',' + ','.join(map(repr, df_as_array[0].tolist())) + '\n')
     print(f"Results saved to {output_path}")
     print(f"Processed patient: {pat_ids[0]}")
 
+def batch_main(lesion_paths, output_dir, output_name, maps_cache=None):
+    # Load the atlas once and reuse it for every lesion
+    maps, map_names = list_maps(PATH_TO_MAPS)
+    if maps_cache:
+        map_nz, map_shape = load_maps_cache(maps, maps_cache)
+    else:
+        map_nz, map_shape = load_sparse_maps(maps)
+    
+    os.makedirs(output_dir, exist_ok=True)
+    for lesion in lesion_paths:
+        pat_id = os.path.basename(lesion).split('_')[0]
+        output_path = os.path.join(output_dir, f'{pat_id}_{output_name}')
+        main(lesion, output_path, map_nz=map_nz, map_names=map_names, map_shape=map_shape)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Analyze lesion-map intersections')
     parser.add_argument('--lesions-path', '-l',
-                        help='Path to lesion file',
+                        help='Path to lesion file (several with --output-dir)',
+                        nargs='+',
                         required=True)
     parser.add_argument('--output-path', '-o',
                         help='Output path for Excel file',
                         default='WM_importance.csv')
+    parser.add_argument('--output-dir',
+                        help='Process all lesions with one atlas load, writing '
+                             '<patient>_<output-path name> files into this directory',
+                        default=None)
+    parser.add_argument('--maps-cache',
+                        help='Path to a .npz file caching the non-zero voxels of '
+                             'every atlas map (created on first use)',
+                        default=None)
     
     args = parser.parse_args()
     
-    # Validate input file exists
-    if not os.path.exists(args.lesions_path):
-        raise FileNotFoundError(f"Lesion file not found: {args.lesions_path}")
+    # Validate input files exist
+    for lesions_path in args.lesions_path:
+        if not os.path.exists(lesions_path):
+            raise FileNotFoundError(f"Lesion file not found: {lesions_path}")
     
-    main(args.lesions_path, args.output_path)
\ No newline at end of file
+    if args.output_dir:
+        batch_main(args.lesions_path, args.output_dir,
+                   os.path.basename(args.output_path), args.maps_cache)
+    elif len(args.lesions_path) == 1:
+        main(args.lesions_path[0], args.output_path, args.maps_cache)
+    else:
+        parser.error('--output-dir is required with several lesion files')
\ No newline at end of file
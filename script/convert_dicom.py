@@ -1,22 +1,42 @@
 import pydicom
+import numpy as np
 import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 input_dir = '/home/alberto/P11/pre/T1/new_nii2dcm/'
 output_dir = '/home/alberto/P11/pre/T1/fixed_nii2dcm/'
 
+# Corrected orientation (with flipped Y components)
+orientation = [0.9995173750741061, -0.030577011219287256, 0.005483001902670556, 0.027891304407167042, 0.9610401413769338, 0.2749980396305939]
+
 # Create output directory
 os.makedirs(output_dir, exist_ok=True)
 
-# Process all DICOM files
-for filename in os.listdir(input_dir):
-    if filename.endswith('.dcm'):
-        # Read DICOM
-        dcm = pydicom.dcmread(os.path.join(input_dir, filename))
-        
-        # Set the corrected orientation (with flipped Y components)
-        dcm.ImageOrientationPatient = [0.9995173750741061, -0.030577011219287256, 0.005483001902670556, 0.027891304407167042, 0.9610401413769338, 0.2749980396305939]
-        
-        # Save corrected DICOM
-        dcm.save_as(os.path.join(output_dir, filename))
+def fix_orientation(filename):
+    input_path = os.path.join(input_dir, filename)
+    output_path = os.path.join(output_dir, filename)
+    
+    # Read DICOM header; large values (pixel data) are deferred and only
+    # streamed from the original file when the corrected copy is written
+    dcm = pydicom.dcmread(input_path, defer_size='1 KB')
+    
+    # Files that already have the target orientation are copied as they are
+    existing = dcm.get('ImageOrientationPatient')
+    if existing is not None and np.allclose(list(existing), orientation, atol=1e-6):
+        if os.path.abspath(input_path) != os.path.abspath(output_path):
+            shutil.copyfile(input_path, output_path)
+        return
+    
+    # Set the corrected orientation
+    dcm.ImageOrientationPatient = orientation
+    
+    # Save corrected DICOM
+    dcm.save_as(output_path)
+
+# Process all DICOM files, overlapping the file I/O on a thread pool
+dicom_files = [filename for filename in os.listdir(input_dir) if filename.endswith('.dcm')]
+with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+    list(ex.map(fix_orientation, dicom_files))
 
-print("All DICOM files processed!")
\ No newline at end of file
+print("All DICOM files processed!")
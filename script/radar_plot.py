@@ -1,10 +1,59 @@
 import pandas as pd
 import numpy as np
+import matplotlib
+matplotlib.use('Agg')  # Solo salvataggio su file, nessuna GUI
 import matplotlib.pyplot as plt
-from math import pi
+from functools import lru_cache
 import os
+import pickle
 import argparse
 
+plt.ioff()
+
+# Risoluzione bozza e pubblicazione; PNG con compressione minima (molto più veloce)
+DRAFT_DPI = 150
+PUBLICATION_DPI = 300
+PNG_KWARGS = {'compress_level': 1, 'optimize': False}
+
+# Margini fissi delle figure: il layout non cambia, niente tight_layout
+COMPARISON_MARGINS = dict(left=0.08, right=0.78, top=0.84, bottom=0.10)
+INDIVIDUAL_MARGINS = dict(left=0.12, right=0.88, top=0.82, bottom=0.14)
+
+# Ordine personalizzato delle categorie
+DESIRED_ORDER = [
+    'Semantic', 'Phonological', 'Speech Arrest', 'Motor', 
+    'Movement Arrest', 'Sensorial', 'Visual', 'Spatial Perception', 
+    'Mentalizing', 'Anomia'
+]
+
+def find_matching_key(desired_key, available_lc):
+    """
+    Trova la chiave disponibile che corrisponde a una categoria desiderata
+    
+    Parameters:
+    - desired_key: nome della categoria cercata
+    - available_lc: dizionario {nome in minuscolo: nome originale}
+    """
+    desired_lc = desired_key.lower()
+    # Cerca corrispondenza esatta prima
+    if desired_lc in available_lc:
+        return available_lc[desired_lc]
+    
+    # Cerca corrispondenze parziali
+    for key_lc, key in available_lc.items():
+        if desired_lc in key_lc or key_lc in desired_lc:
+            return key
+    return None
+
+@lru_cache(maxsize=None)
+def radar_angles(N):
+    """
+    Angoli degli N assi del radar plot, con il primo ripetuto in coda
+    per chiudere il cerchio (array condiviso, da non modificare)
+    """
+    angles = np.linspace(0, 2 * np.pi, N, endpoint=False)
+    return np.concatenate([angles, angles[:1]])
+
 def create_radar_plot(data_dict, title, color, ax):
     """
     Crea un radar plot per i dati forniti
@@ -15,45 +64,28 @@ def create_radar_plot(data_dict, title, color, ax):
     - color: colore del grafico
     - ax: asse matplotlib
     """
-    # Ordine personalizzato delle categorie
-    desired_order = [
-        'Semantic', 'Phonological', 'Speech Arrest', 'Motor', 
-        'Movement Arrest', 'Sensorial', 'Visual', 'Spatial Perception', 
-        'Mentalizing', 'Anomia'
-    ]
-    
-    # Funzione per mappare nomi simili
-    def find_matching_key(desired_key, available_keys):
-        # Cerca corrispondenza esatta prima
-        if desired_key in available_keys:
-            return desired_key
-        
-        # Cerca corrispondenze parziali
-        for key in available_keys:
-            if desired_key.lower() in key.lower() or key.lower() in desired_key.lower():
-                return key
-        return None
-    
     # Riordina i dati secondo l'ordine desiderato
     ordered_data = {}
-    available_keys = list(data_dict.keys())
+    available_lc = {key.lower(): key for key in data_dict}
     
     # Prima aggiungi le categorie nell'ordine desiderato
-    for desired_key in desired_order:
-        matching_key = find_matching_key(desired_key, available_keys)
+    for desired_key in DESIRED_ORDER:
+        matching_key = find_matching_key(desired_key, available_lc)
         if matching_key:
             ordered_data[matching_key] = data_dict[matching_key]
-            available_keys.remove(matching_key)
+            del available_lc[matching_key.lower()]
     
     # Poi aggiungi eventuali categorie rimanenti
-    for remaining_key in available_keys:
+    ordered_lc = [existing.lower() for existing in ordered_data]
+    for remaining_lc, remaining_key in available_lc.items():
         # Salta categorie che sembrano essere varianti di quelle già incluse
-        if not any(remaining_key.lower() in existing.lower() for existing in ordered_data.keys()):
+        if not any(remaining_lc in existing for existing in ordered_lc):
             ordered_data[remaining_key] = data_dict[remaining_key]
+            ordered_lc.append(remaining_lc)
     
     # Prepara i dati riordinati
     categories = list(ordered_data.keys())
-    values = list(ordered_data.values())
+    values = np.fromiter(ordered_data.values(), dtype=np.float64, count=len(ordered_data))
     
     print(f"   🔄 Ordine finale per {title}: {categories}")
     
@@ -61,14 +93,13 @@ def create_radar_plot(data_dict, title, color, ax):
     N = len(categories)
     
     # Calcola gli angoli per ogni asse
-    angles = [n / float(N) * 2 * pi for n in range(N)]
-    angles += angles[:1]  # Chiude il cerchio
+    angles = radar_angles(N)
     
     # Aggiungi il primo valore alla fine per chiudere il poligono
-    values += values[:1]
+    values = np.concatenate([values, values[:1]])
     
     # Plot
-    ax.set_theta_offset(pi / 2)
+    ax.set_theta_offset(np.pi / 2)
     ax.set_theta_direction(-1)
     
     # Disegna il radar plot con stile migliorato
@@ -145,39 +176,63 @@ def load_and_process_data(gm_file, wm_file):
             print(f"   ✅ Colonna processata: '{col}' -> '{clean_name}'")
         return cleaned
     
+    # Funzione per convertire la prima riga in un unico passaggio vettoriale
+    def extract_first_row(df, columns):
+        orig_cols = [orig_col for orig_col, _ in columns]
+        values = pd.to_numeric(df[orig_cols].iloc[0], errors='coerce').to_numpy(dtype=np.float64)
+        data = {}
+        for (orig_col, clean_col), value in zip(columns, values.tolist()):
+            if np.isnan(value):
+                print(f"   ⚠️  Valore non numerico in {orig_col}, saltato")
+                continue
+            data[clean_col] = value
+            print(f"   📊 {clean_col}: {value:.3f}")
+        return data
+    
     # Processa GM data
     print("🔧 Processamento dati GM...")
-    gm_columns = clean_column_names(gm_df.columns)
-    gm_data = {}
-    for orig_col, clean_col in gm_columns:
-        if orig_col in gm_df.columns:
-            try:
-                value = float(gm_df[orig_col].iloc[0])
-                gm_data[clean_col] = value
-                print(f"   📊 {clean_col}: {value:.3f}")
-            except (ValueError, TypeError) as e:
-                print(f"   ⚠️  Errore conversione {orig_col}: {e}")
-                continue
+    gm_data = extract_first_row(gm_df, clean_column_names(gm_df.columns))
     print(f"   ✅ Variabili GM processate: {len(gm_data)}")
     
     # Processa WM data
     print("🔧 Processamento dati WM...")
-    wm_columns = clean_column_names(wm_df.columns)
-    wm_data = {}
-    for orig_col, clean_col in wm_columns:
-        if orig_col in wm_df.columns:
-            try:
-                value = float(wm_df[orig_col].iloc[0])
-                wm_data[clean_col] = value
-                print(f"   📊 {clean_col}: {value:.3f}")
-            except (ValueError, TypeError) as e:
-                print(f"   ⚠️  Errore conversione {orig_col}: {e}")
-                continue
+    wm_data = extract_first_row(wm_df, clean_column_names(wm_df.columns))
     print(f"   ✅ Variabili WM processate: {len(wm_data)}")
     
     return gm_data, wm_data
 
-def create_comparison_radar_plot(gm_data, wm_data, save_path=None):
+def load_data_cached(gm_file, wm_file, cache_path):
+    """
+    Come load_and_process_data, ma riusa i dati già processati salvati in
+    cache_path finché i due file CSV non cambiano (stesso percorso e mtime)
+    
+    Parameters:
+    - gm_file: path del file CSV per materia grigia
+    - wm_file: path del file CSV per materia bianca
+    - cache_path: path del file pickle con i dati memorizzati
+    """
+    key = None
+    if os.path.exists(gm_file) and os.path.exists(wm_file):
+        key = (os.path.abspath(gm_file), os.stat(gm_file).st_mtime_ns,
+               os.path.abspath(wm_file), os.stat(wm_file).st_mtime_ns)
+        try:
+            with open(cache_path, 'rb') as f:
+                cached_key, gm_data, wm_data = pickle.load(f)
+            if cached_key == key:
+                print(f"♻️  Dati ricaricati dalla cache: {cache_path}")
+                return gm_data, wm_data
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            pass
+    
+    gm_data, wm_data = load_and_process_data(gm_file, wm_file)
+    try:
+        with open(cache_path, 'wb') as f:
+            pickle.dump((key, gm_data, wm_data), f)
+    except OSError:
+        pass  # Cache non scrivibile: si ricalcola al prossimo avvio
+    return gm_data, wm_data
+
+def create_comparison_radar_plot(gm_data, wm_data, save_path=None, ax=None, dpi=DRAFT_DPI):
     """
     Crea un radar plot comparativo per GM e WM
     
@@ -185,34 +240,22 @@ def create_comparison_radar_plot(gm_data, wm_data, save_path=None):
     - gm_data: dizionario con dati materia grigia
     - wm_data: dizionario con dati materia bianca
     - save_path: percorso per salvare il grafico (opzionale)
+    - ax: asse polare matplotlib da riutilizzare (opzionale)
+    - dpi: risoluzione del PNG salvato
     """
     
-    # Ordine personalizzato delle categorie
-    desired_order = [
-        'Semantic', 'Phonological', 'Speech Arrest', 'Motor', 
-        'Movement Arrest', 'Sensorial', 'Visual', 'Spatial Perception', 
-        'Mentalizing', 'Anomia'
-    ]
-    
-    # Funzione per mappare nomi simili
-    def find_matching_key(desired_key, available_keys):
-        if desired_key in available_keys:
-            return desired_key
-        for key in available_keys:
-            if desired_key.lower() in key.lower() or key.lower() in desired_key.lower():
-                return key
-        return None
-    
     # Trova le categorie comuni e riordinale
     common_categories = set(gm_data.keys()) & set(wm_data.keys())
+    available_lc = {key.lower(): key for key in common_categories}
     ordered_categories = []
     
     # Aggiungi categorie nell'ordine desiderato
-    for desired_key in desired_order:
-        matching_key = find_matching_key(desired_key, common_categories)
+    for desired_key in DESIRED_ORDER:
+        matching_key = find_matching_key(desired_key, available_lc)
         if matching_key:
             ordered_categories.append(matching_key)
             common_categories.remove(matching_key)
+            del available_lc[matching_key.lower()]
     
     # Aggiungi eventuali categorie rimanenti
     ordered_categories.extend(sorted(list(common_categories)))
@@ -224,23 +267,28 @@ def create_comparison_radar_plot(gm_data, wm_data, save_path=None):
     gm_filtered = {cat: gm_data[cat] for cat in ordered_categories}
     wm_filtered = {cat: wm_data[cat] for cat in ordered_categories}
     
-    # Crea il grafico comparativo
-    fig, ax = plt.subplots(figsize=(16, 12), subplot_kw=dict(projection='polar'))
+    # Crea il grafico comparativo, o riusa l'asse fornito
+    if ax is None:
+        fig, ax = plt.subplots(figsize=(16, 12), subplot_kw=dict(projection='polar'),
+                               constrained_layout=False)
+        fig.subplots_adjust(**COMPARISON_MARGINS)
+    else:
+        fig = ax.figure
+        ax.clear()
     
     # Prepara i dati
     categories = list(gm_filtered.keys())
-    gm_values = list(gm_filtered.values())
-    wm_values = list(wm_filtered.values())
+    gm_values = np.fromiter(gm_filtered.values(), dtype=np.float64, count=len(gm_filtered))
+    wm_values = np.fromiter(wm_filtered.values(), dtype=np.float64, count=len(wm_filtered))
     
     N = len(categories)
-    angles = [n / float(N) * 2 * pi for n in range(N)]
-    angles += angles[:1]
+    angles = radar_angles(N)
     
-    gm_values += gm_values[:1]
-    wm_values += wm_values[:1]
+    gm_values = np.concatenate([gm_values, gm_values[:1]])
+    wm_values = np.concatenate([wm_values, wm_values[:1]])
     
     # Plot con colori personalizzati
-    ax.set_theta_offset(pi / 2)
+    ax.set_theta_offset(np.pi / 2)
     ax.set_theta_direction(-1)
     
     # Colori personalizzati: ocra-oro per GM, grigio chiaro per WM
@@ -267,55 +315,55 @@ def create_comparison_radar_plot(gm_data, wm_data, save_path=None):
     ax.grid(True, alpha=0.6, linewidth=0.8)
     
     # Titolo e legenda migliorati
-    plt.title('Confronto Importanza Funzioni Cognitive\nMateria Grigia vs Materia Bianca', 
+    ax.set_title('Confronto Importanza Funzioni Cognitive\nMateria Grigia vs Materia Bianca', 
               size=18, weight='bold', pad=35)
-    plt.legend(loc='upper right', bbox_to_anchor=(1.25, 1.1), fontsize=12, framealpha=0.9)
-    
-    plt.tight_layout()
+    ax.legend(loc='upper right', bbox_to_anchor=(1.25, 1.1), fontsize=12, framealpha=0.9)
     
     if save_path:
         full_path = os.path.abspath(save_path)
-        plt.savefig(save_path, dpi=300, bbox_inches='tight', facecolor='white')
+        fig.savefig(save_path, dpi=dpi, facecolor='white',
+                    pil_kwargs=PNG_KWARGS)
         print(f"✅ Grafico comparativo salvato: {full_path}")
     
-    plt.show()
     return fig
 
-def create_individual_plots(gm_data, wm_data, save_prefix=None):
+def create_individual_plots(gm_data, wm_data, save_prefix=None, ax=None, dpi=DRAFT_DPI):
     """
-    Crea radar plot individuali per GM e WM come file PNG separati
+    Crea radar plot individuali per GM e WM come file PNG separati,
+    disegnati in sequenza sulla stessa figura
     """
     # Colori personalizzati: ocra-oro per GM, grigio chiaro per WM
     gm_color = '#DAA520'  # Goldenrod (ocra-oro)
     wm_color = '#808080'  # Gray (grigio medio)
     
-    # PRIMO GRAFICO: Solo GM
-    fig1, ax1 = plt.subplots(figsize=(12, 10), subplot_kw=dict(projection='polar'))
-    create_radar_plot(gm_data, 'Materia Grigia (GM)', gm_color, ax1)
-    plt.tight_layout()
+    if ax is None:
+        fig, ax = plt.subplots(figsize=(12, 10), subplot_kw=dict(projection='polar'),
+                               constrained_layout=False)
+        fig.subplots_adjust(**INDIVIDUAL_MARGINS)
+    else:
+        fig = ax.figure
     
+    # PRIMO GRAFICO: Solo GM
+    ax.clear()
+    create_radar_plot(gm_data, 'Materia Grigia (GM)', gm_color, ax)
     if save_prefix:
         gm_path = f'{save_prefix}_GM.png'
         full_gm_path = os.path.abspath(gm_path)
-        plt.savefig(gm_path, dpi=300, bbox_inches='tight', facecolor='white')
+        fig.savefig(gm_path, dpi=dpi, facecolor='white',
+                    pil_kwargs=PNG_KWARGS)
         print(f"✅ Grafico GM salvato: {full_gm_path}")
     
-    plt.show()
-    
-    # SECONDO GRAFICO: Solo WM
-    fig2, ax2 = plt.subplots(figsize=(12, 10), subplot_kw=dict(projection='polar'))
-    create_radar_plot(wm_data, 'Materia Bianca (WM)', wm_color, ax2)
-    plt.tight_layout()
-    
+    # SECONDO GRAFICO: Solo WM, sulla stessa figura
+    ax.clear()
+    create_radar_plot(wm_data, 'Materia Bianca (WM)', wm_color, ax)
     if save_prefix:
         wm_path = f'{save_prefix}_WM.png'
         full_wm_path = os.path.abspath(wm_path)
-        plt.savefig(wm_path, dpi=300, bbox_inches='tight', facecolor='white')
+        fig.savefig(wm_path, dpi=dpi, facecolor='white',
+                    pil_kwargs=PNG_KWARGS)
         print(f"✅ Grafico WM salvato: {full_wm_path}")
     
-    plt.show()
-    
-    return fig1, fig2
+    return fig
 
 def create_sample_data():
     """
@@ -352,7 +400,19 @@ def create_sample_data():
     }
     return gm_sample, wm_sample
 
-def run_example(output_dir='.'):
+def example_output_paths(output_dir):
+    """
+    Percorsi dei file di output per i grafici con dati di esempio
+    
+    Returns:
+    - comparison_path: path del grafico comparativo
+    - individual_prefix: prefisso dei grafici individuali
+    """
+    comparison_path = os.path.join(output_dir, "radar_comparison_example.png")
+    individual_prefix = os.path.join(output_dir, "radar_example")
+    return comparison_path, individual_prefix
+
+def run_example(output_dir='.', dpi=DRAFT_DPI):
     """
     Esegue l'esempio con dati simulati
     """
@@ -368,11 +428,10 @@ def run_example(output_dir='.'):
     print(f"📂 Directory di output: {os.path.abspath(output_dir)}")
     
     # Crea i percorsi completi per i file di output
-    comparison_path = os.path.join(output_dir, "radar_comparison_example.png")
-    individual_prefix = os.path.join(output_dir, "radar_example")
+    comparison_path, individual_prefix = example_output_paths(output_dir)
     
-    create_comparison_radar_plot(gm_data, wm_data, comparison_path)
-    create_individual_plots(gm_data, wm_data, individual_prefix)
+    create_comparison_radar_plot(gm_data, wm_data, comparison_path, dpi=dpi)
+    create_individual_plots(gm_data, wm_data, individual_prefix, dpi=dpi)
 
 # ESECUZIONE PRINCIPALE
 if __name__ == "__main__":
@@ -388,11 +447,15 @@ if __name__ == "__main__":
     parser.add_argument('--output_dir', '-o',
                         help='Output directory for saving plots',
                         default='.')
+    parser.add_argument('--publication',
+                        help=f'Save plots at {PUBLICATION_DPI} DPI instead of the {DRAFT_DPI} DPI draft',
+                        action='store_true')
     
     args = parser.parse_args()
     gm_file = args.gray_matter
     wm_file = args.white_matter
     output_directory = args.output_dir
+    dpi = PUBLICATION_DPI if args.publication else DRAFT_DPI
     
     # Assicurati che la directory di output esista
     os.makedirs(output_directory, exist_ok=True)
@@ -405,10 +468,13 @@ if __name__ == "__main__":
     print(f"🎯 File GM target: {gm_file}")
     print(f"🎯 File WM target: {wm_file}")
     
-    # Prova prima con i file reali
+    # Prova prima con i file reali (dati memorizzati se i CSV non sono cambiati)
+    cache_path = os.path.join(output_directory, '.radar_data_cache.pkl')
+    comparison_path = os.path.join(output_directory, "radar_comparison.png")
+    individual_prefix = os.path.join(output_directory, "radar_plots")
     try:
         print("\n📁 Tentativo di caricamento file CSV...")
-        gm_data, wm_data = load_and_process_data(gm_file, wm_file)
+        gm_data, wm_data = load_data_cached(gm_file, wm_file, cache_path)
         
         print("\n✅ File caricati con successo!")
         print(f"📊 Funzioni GM trovate: {len(gm_data)}")
@@ -420,34 +486,37 @@ if __name__ == "__main__":
             print(f"   {func}: {val:.3f}")
         if len(gm_data) > 3:
             print("   ...")
-        
-        print("\n🎨 Creazione grafici...")
-        
-        # Crea i percorsi completi per i file di output
-        comparison_path = os.path.join(output_directory, "radar_comparison.png")
-        individual_prefix = os.path.join(output_directory, "radar_plots")
-        
-        # Crea grafico comparativo
+    
+    except (FileNotFoundError, ValueError, KeyError, IndexError) as e:
+        # Anche pd.errors.ParserError ed EmptyDataError sono ValueError
+        print(f"\n❌ Errore durante il caricamento dei CSV: {e}")
+        print("🔄 Passaggio ai dati di esempio...")
+        gm_data, wm_data = create_sample_data()
+        comparison_path, individual_prefix = example_output_paths(output_directory)
+    
+    print("\n🎨 Creazione grafici...")
+    generated = []
+    
+    # Crea grafico comparativo
+    try:
         print("   📈 Radar plot comparativo...")
-        create_comparison_radar_plot(gm_data, wm_data, comparison_path)
-        
-        # Crea grafici individuali
+        create_comparison_radar_plot(gm_data, wm_data, comparison_path, dpi=dpi)
+        generated.append(f"{os.path.basename(comparison_path)} (grafico comparativo)")
+    except (ValueError, OSError) as e:
+        print(f"\n❌ Errore nel grafico comparativo: {e}")
+    
+    # Crea grafici individuali (indipendenti dal comparativo)
+    try:
         print("   📊 Radar plot individuali...")
-        create_individual_plots(gm_data, wm_data, individual_prefix)
-        
+        create_individual_plots(gm_data, wm_data, individual_prefix, dpi=dpi)
+        generated.append(f"{os.path.basename(individual_prefix)}_GM.png (solo materia grigia)")
+        generated.append(f"{os.path.basename(individual_prefix)}_WM.png (solo materia bianca)")
+    except (ValueError, OSError) as e:
+        print(f"\n❌ Errore nei grafici individuali: {e}")
+    
+    if generated:
         print("\n✅ GRAFICI CREATI CON SUCCESSO!")
         print(f"📂 File salvati nella directory: {os.path.abspath(output_directory)}")
         print("📄 File generati:")
-        print(f"   - {os.path.basename(comparison_path)} (grafico comparativo)")
-        print(f"   - {os.path.basename(individual_prefix)}_GM.png (solo materia grigia)")
-        print(f"   - {os.path.basename(individual_prefix)}_WM.png (solo materia bianca)")
-        
-    except FileNotFoundError as e:
-        print(f"\n❌ File non trovato: {e}")
-        print("🔄 Passaggio ai dati di esempio...")
-        run_example(output_directory)
-        
-    except Exception as e:
-        print(f"\n❌ Errore durante l'elaborazione: {e}")
-        print("🔄 Passaggio ai dati di esempio...")
-        run_example(output_directory)
\ No newline at end of file
+        for description in generated:
+            print(f"   - {description}")